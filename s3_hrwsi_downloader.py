@@ -51,22 +51,57 @@
 import os
 import re
 import sys
+import json
+import hashlib
 import logging
+import threading
 import datetime
 import argparse
+import functools
 from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from retry import retry
 import boto3
+from boto3.s3.transfer import TransferConfig, create_transfer_manager
+from botocore.config import Config
 from botocore.exceptions import ClientError, EndpointConnectionError
+from s3transfer.subscribers import BaseSubscriber
 from tqdm import tqdm
-from shapely import GEOSException
+from shapely import GEOSException, from_wkt
+from shapely.ops import transform
 import geopandas as gpd
+from pyproj import Transformer
 from pyproj.crs import CRSError
 from pyogrio.errors import DataSourceError
 
 
 
 
+@functools.lru_cache(maxsize=4)
+def _load_mgrs(mgrs_file):
+    '''
+    Reads the MGRS tiles file once and keeps it in memory, with its spatial index built.
+    '''
+    tile_gpd = gpd.read_file(mgrs_file)
+    tile_gpd.sindex  # build the spatial index once, while the frame is cached
+    return tile_gpd
+
+
+class TransferSizeSubscriber(BaseSubscriber):
+    '''
+    Gives the size and ETag of a layer, already known from the listing, to the transfer manager
+    so that it does not call head_object to get them.
+    The ETag keeps the ranged GETs of a multipart download bound to the same object version.
+    '''
+    def __init__(self, size, etag):
+        self.size = size
+        self.etag = etag
+
+    def on_queued(self, future, **kwargs):
+        future.meta.provide_transfer_size(self.size)
+        future.meta.provide_object_etag(f'"{self.etag}"')
+
+
 class HRWSIRequest(object):
     '''
     Request HRWSI products in the catalogue.     
@@ -85,11 +120,27 @@ class HRWSIRequest(object):
     #DOWNLOAD THRESHOLD ABOVE WHICH DOWNLOADS WILL NOT START
     DOWNLOAD_THRESHOLD=500
 
+    #NB OF (PRODUCT TYPE, TILE) PAIRS LISTED IN PARALLEL
+    LISTING_WORKERS=32
+
+    #NB OF PRODUCTS DOWNLOADED IN PARALLEL
+    DOWNLOAD_WORKERS=16
+
+    #NB OF CONCURRENT REQUESTS OF THE TRANSFER MANAGER DOWNLOADING THE LAYERS
+    TRANSFER_CONCURRENCY=16
+
+    #SIZE ABOVE WHICH A LAYER IS DOWNLOADED BY CHUNKS OF THE SAME SIZE WITH RANGED GETS
+    MULTIPART_CHUNKSIZE=8*1024*1024
+
+    #NB OF HTTP CONNECTIONS KEPT OPEN BY THE SHARED S3 CLIENT
+    MAX_POOL_CONNECTIONS=64
+
     #DATE FORMAT
     DATE_FORMAT = '%Y-%m-%d'
 
     #TILE FORMAT
     TILE_FORMAT = 'T##XXX or ##XXX'
+    TILE_REGEX = re.compile(r'T?(\d{2}[A-Z]{3})')
 
     #RESULT DIR
     RESULT_DIR = 'result'
@@ -125,16 +176,24 @@ class HRWSIRequest(object):
 
         self.query_file = None
 
+        # product types available in the catalogue, listed on first validation
+        self.product_types = None
+
+        # local product directories already created, shared by the download threads
+        self.created_dirs = set()
+        self.created_dirs_lock = threading.Lock()
+
     def validate_product_type(self,product_type):
         '''
         Makes sure that the product type exists in the HRWSI catalogue
+        The top-level directories of the catalogue are listed only once for all the product types.
         '''
-        valid = False
-        for _ in self.s3_client.Bucket(HRWSIRequest.BUCKET).objects.filter(Prefix=product_type+"/"):
-            valid = True
-            break
-            
-        if not valid:
+        if self.product_types is None:
+            self.product_types = {prefix['Prefix'].rstrip('/')
+                                  for page in self.list_paginator.paginate(Bucket=HRWSIRequest.BUCKET, Delimiter='/')
+                                  for prefix in page.get('CommonPrefixes', [])}
+
+        if product_type not in self.product_types:
             logging.error(f"-productType : {product_type} does not exist")
             sys.exit("-2")
             
@@ -162,15 +221,11 @@ class HRWSIRequest(object):
         '''
         Makes sure that the tile are in the right format
         '''
-        tile = None
-        found = re.search(r'\d{2}'+ '[A-Z]{3}', tile_text)
-        if found != None and ((len(tile_text) == 6 and tile_text[0]=="T") or (len(tile_text) == 5 )):
-            tile = found
-        try:
-            return tile.group(0)
-        except:
+        found = HRWSIRequest.TILE_REGEX.fullmatch(tile_text)
+        if not found:
             logging.error(f"-tile : {tile_text} as incorrect tile format, should be " + HRWSIRequest.TILE_FORMAT)
             sys.exit(-2)
+        return found.group(1)
 
 
     def validate_wkt_epsg(self,epsg_text,wkt_text):
@@ -197,7 +252,7 @@ class HRWSIRequest(object):
         Makes sure that the MGRS file exists and is valid
         '''
         try:
-            test_gpd = gpd.read_file(mgrs_file)
+            _load_mgrs(mgrs_file)
         except DataSourceError as err:
             logging.error(f"mgrs file : {err}")
             sys.exit("-2")
@@ -227,10 +282,18 @@ class HRWSIRequest(object):
             logging.error(f"-vector : {err}")
             sys.exit("-2")
 
-        test_wkt = str(test_gpd.union_all())
-        test_epsg = test_gpd.crs.to_epsg()
+        if test_gpd.crs is None:
+            logging.error(f"-vector : no projection system found")
+            sys.exit("-2")
+
+        # features without geometry are ignored
+        test_gpd = test_gpd[~(test_gpd.geometry.isna() | test_gpd.geometry.is_empty)]
+
+        if not test_gpd.geom_type.isin(['MultiPolygon','Polygon']).all():
+            logging.error(f"-vector : only Polygon or MultiPolygon is accepted")
+            sys.exit("-2")
 
-        return self.validate_wkt_epsg(test_epsg,test_wkt)
+        return test_gpd
 
 
     def set_query_file(self, query_file):
@@ -242,26 +305,43 @@ class HRWSIRequest(object):
         response_checksum_validation="when_required" was added as a workaround to the bug 
         that spams checksum warnings since the beginning of this year (jan 2025):
         https://github.com/boto/botocore/issues/3382
+        The low-level client and its list_objects_v2 paginator are shared by all the listing and download threads.
+        The transfer manager downloads the layers with concurrent multipart ranged GETs.
         '''
         logging.info("Set S3 client to access bucket %s at %s."%(HRWSIRequest.BUCKET,HRWSIRequest.ENDPOINT_URL))
-        self.s3_client = boto3.resource("s3",
+        self.s3_session = boto3.session.Session(
                                  aws_access_key_id=HRWSIRequest.ACCESS_KEY,
-                                 aws_secret_access_key=HRWSIRequest.SECRET_KEY,
-                                 endpoint_url=HRWSIRequest.ENDPOINT_URL)
-
-    def find_MGRS_tiles(self,epsg_text,wkt_text):
-        tile_gpd = gpd.read_file(HRWSIRequest.MGRS_FILE)
-
-        poly_gpd = gpd.GeoDataFrame(
-            geometry=gpd.GeoSeries.from_wkt(
-                [wkt_text],
-                crs=epsg_text)).to_crs(tile_gpd.crs)
+                                 aws_secret_access_key=HRWSIRequest.SECRET_KEY)
+        self.s3_client = self.s3_session.client("s3",
+                                 endpoint_url=HRWSIRequest.ENDPOINT_URL,
+                                 config=Config(
+                                     max_pool_connections=HRWSIRequest.MAX_POOL_CONNECTIONS,
+                                     response_checksum_validation="when_required",
+                                     retries={'max_attempts': 5, 'mode': 'adaptive'}))
+        self.list_paginator = self.s3_client.get_paginator('list_objects_v2')
+        self.transfer_manager = create_transfer_manager(self.s3_client,
+                                 TransferConfig(
+                                     multipart_threshold=HRWSIRequest.MULTIPART_CHUNKSIZE,
+                                     multipart_chunksize=HRWSIRequest.MULTIPART_CHUNKSIZE,
+                                     max_concurrency=HRWSIRequest.TRANSFER_CONCURRENCY,
+                                     use_threads=True))
+
+    def find_MGRS_tiles(self,epsg_text=None,wkt_text=None,vector_gpd=None):
+        '''
+        Finds the MGRS tiles intersecting either the wkt, given in the epsg projection system,
+        or any of the features of the vector GeoDataFrame.
+        '''
+        tile_gpd = _load_mgrs(HRWSIRequest.MGRS_FILE)
 
-        tile_gpd['foundTiles']= tile_gpd.index
-        intersecting = poly_gpd.sjoin(tile_gpd, how='inner')['foundTiles']
-        found_tiles_gpd = tile_gpd[tile_gpd.foundTiles.isin(intersecting)]
+        if vector_gpd is not None:
+            polys = vector_gpd.geometry.to_crs(tile_gpd.crs).values
+            idx = sorted(set(tile_gpd.sindex.query(polys, predicate='intersects')[1]))
+        else:
+            transformer = Transformer.from_crs(epsg_text, tile_gpd.crs, always_xy=True)
+            poly = transform(transformer.transform, from_wkt(wkt_text))
+            idx = tile_gpd.sindex.query(poly, predicate='intersects')
 
-        return found_tiles_gpd.Name.to_list()
+        return tile_gpd.iloc[idx]['Name'].to_list()
 
 
     def build_query(self,
@@ -298,11 +378,11 @@ class HRWSIRequest(object):
         if vector:
             self.validate_MGRS_file(HRWSIRequest.MGRS_FILE)
             self.request_params[HRWSIRequest.TILES] = \
-                self.find_MGRS_tiles(*self.validate_vector(vector))
+                self.find_MGRS_tiles(vector_gpd=self.validate_vector(vector))
 
         if tiles:
             self.request_params[HRWSIRequest.TILES] = \
-                [self.validate_tile_format(tile).upper() for tile in tiles ]
+                [self.validate_tile_format(tile) for tile in tiles ]
 
         if len(self.request_params[HRWSIRequest.TILES]) == 0:
             logging.error("No tiles were identified")
@@ -324,55 +404,90 @@ class HRWSIRequest(object):
         return
 
 
+    def list_products(self, pT, tile, date_path_start, date_path_end):
+        '''
+        Parse the catalogue once for one product type and one tile, starting after the start date
+        and stopping at the first file dated after the end date.
+        This fast method is possible because S3 lists the keys in lexicographical order.
+        The dates are given as year/month/day paths.
+        Returns the total size of the files found and their keys, sizes and ETags grouped by product.
+        '''
+        marker_start = f"{pT}/{tile}/{date_path_start}"
+        marker_end = f"{pT}/{tile}/{date_path_end}"
+        prefix = f"{pT}/{tile}"
+        size_b = 0
+        products = {}
+        pages = self.list_paginator.paginate(Bucket=HRWSIRequest.BUCKET,
+                                             Prefix=prefix,
+                                             StartAfter=marker_start,
+                                             PaginationConfig={'PageSize': 1000})
+        end_reached = False
+        for page in pages:
+            for content in page.get('Contents', []):
+                layer = content['Key']
+                if layer >= marker_end:
+                    end_reached = True
+                    break
+                size = int(content['Size'])
+                size_b+=size
+                product = products.setdefault(layer.rpartition('/')[0], {'keys': [], 'sizes': [], 'etags': []})
+                product['keys'].append(layer)
+                product['sizes'].append(size)
+                product['etags'].append(content['ETag'].strip('"'))
+            if end_reached:
+                break
+
+        return size_b, products
+
     def execute_request(self):
         '''
-        For each tile and each product type, parse the catalogue two times:
-        first time: extract a list of all the available files starting at the start date (this will include the data after the end date)
-        second time: extract a list of all the available files starting at the end date 
-        the second list is then substracted from the first list, leaving only the data between the start and end dates.
-        This fast method is possible because the products are apparently parsed by boto3 in the lexicographical order.  
-        Generates a query_file.txt with a list of the found products (directories containing the layer files for each unique product).
+        For each tile and each product type, parse the catalogue between the start and end dates.
+        The (product type, tile) pairs are listed concurrently with the shared S3 client.
+        Generates a query_file.txt listing the found products (directories containing the layer files for each unique product),
+        one JSON object per line with the keys, sizes and ETags of the layer files of the product.
         '''
 
         start_date = datetime.datetime.strptime(self.request_params[HRWSIRequest.START_DATE], HRWSIRequest.DATE_FORMAT).date()
         start_marker_date = start_date
         end_date = datetime.datetime.strptime(self.request_params[HRWSIRequest.END_DATE], HRWSIRequest.DATE_FORMAT).date()
         end_marker_date = end_date + datetime.timedelta(days=1)
+        date_path_start = start_marker_date.strftime('%Y/%m/%d')
+        date_path_end = end_marker_date.strftime('%Y/%m/%d')
         total_size_b = 0
-        total_list_products = []
+        total_products = {}
         logging.info("Search period : " + f"{start_date.strftime(HRWSIRequest.DATE_FORMAT)} - {end_date.strftime(HRWSIRequest.DATE_FORMAT)}")
-        for pT in self.request_params[HRWSIRequest.PRODUCT_TYPE]:
-            logging.info("    Looking for product type : " + pT)
-            for tile in tqdm(self.request_params[HRWSIRequest.TILES]):
-                #logging.info("        Looking for tile : " + tile)
-                marker_start = f"{pT}/{tile}/{start_marker_date.year}/{start_marker_date.strftime('%m')}/{start_marker_date.strftime('%d')}"
-                marker_end = f"{pT}/{tile}/{end_marker_date.year}/{end_marker_date.strftime('%m')}/{end_marker_date.strftime('%d')}"
-                prefix = f"{pT}/{tile}"
-                contents_to_filter = [obj for obj in self.s3_client.Bucket(HRWSIRequest.BUCKET).objects.filter(Prefix = prefix,Marker=marker_start)]
-                contents_filter = [obj for obj in self.s3_client.Bucket(HRWSIRequest.BUCKET).objects.filter(Prefix = prefix,Marker=marker_end)]
-                contents = [item for item in contents_to_filter if item not in contents_filter]
-                size_b = 0
-                list_products = []
-                for content in contents:
-                    layer = content.key
-                    size =int(content.size)
-                    size_b+=size
-                    product = os.path.dirname(layer)
-                    if product not in list_products: list_products.append(product)
-                total_size_b+=size_b  
-                total_list_products.extend(list_products)
-        logging.info(f"Total number of products found : {len(total_list_products)}" )
-        if len(total_list_products) == 0:
+        logging.info("    Looking for product types : " + " ".join(self.request_params[HRWSIRequest.PRODUCT_TYPE]))
+        jobs = [(pT, tile)
+                for pT in self.request_params[HRWSIRequest.PRODUCT_TYPE]
+                for tile in self.request_params[HRWSIRequest.TILES]]
+        with ThreadPoolExecutor(max_workers=min(HRWSIRequest.LISTING_WORKERS, len(jobs))) as ex:
+            futures = [ex.submit(self.list_products, pT, tile, date_path_start, date_path_end)
+                       for pT, tile in jobs]
+            try:
+                with tqdm(total=len(jobs)) as pbar:
+                    for future in as_completed(futures):
+                        size_b, products = future.result()
+                        total_size_b+=size_b
+                        total_products.update(products)
+                        pbar.update(1)
+            except BaseException:
+                # do not wait for the pending listings before raising the error
+                for future in futures:
+                    future.cancel()
+                raise
+        logging.info(f"Total number of products found : {len(total_products)}" )
+        if len(total_products) == 0:
                     logging.warning(f"            No product found for the entire query !")
         logging.info(f"Total size of products found (Mb): {round(total_size_b /1000000)}" )
 
-        if len(total_list_products) > HRWSIRequest.DOWNLOAD_THRESHOLD:
+        if len(total_products) > HRWSIRequest.DOWNLOAD_THRESHOLD:
             logging.warning(f"Warning: nb of products above the download threshold of {HRWSIRequest.DOWNLOAD_THRESHOLD}.")
 
         self.set_query_file(os.path.join(self.outputPath, f"query_file.txt"))
         logging.info("Listing query results in " + self.query_file)
         with open(self.query_file, 'w') as f:
-            f.writelines([res+"\n" for res in total_list_products])
+            f.writelines(json.dumps({'product': product, **total_products[product]})+"\n"
+                         for product in sorted(total_products))
         return
 
     def download(self):
@@ -390,7 +505,16 @@ class HRWSIRequest(object):
         try:
             with open(self.query_file) as f:
                 content = f.readlines()
-            product_list = [x.strip() for x in content if x.strip()]
+            product_list = []
+            for line in content:
+                line = line.strip()
+                if not line:
+                    continue
+                if line.startswith('{'):
+                    product_list.append(json.loads(line))
+                else:
+                    # query files from previous versions only list the product directories
+                    product_list.append({'product': line, 'keys': None, 'sizes': None, 'etags': None})
             
         except :
             logging.error("Error while parsing query_file file: " + str(self.query_file))
@@ -400,32 +524,87 @@ class HRWSIRequest(object):
             logging.error(f"Nb of products above the download threshold of {HRWSIRequest.DOWNLOAD_THRESHOLD}")
             raise
             
-        # loop to download all products within the list
+        # download all products within the list in parallel
+        # the transfer manager is shut down before the thread pool, so that on error
+        # the layers still queued are cancelled instead of being downloaded
         logging.info(f"start downloading {len(product_list)} products")
-        for info_product in tqdm(product_list):
-
-            # start actual download
-            self.download_from_s3(info_product)
-        
-        
-            
+        with ThreadPoolExecutor(max_workers=HRWSIRequest.DOWNLOAD_WORKERS) as ex, self.transfer_manager:
+            list(tqdm(ex.map(self.download_from_s3, product_list), total=len(product_list)))
 
+    def make_product_dir(self, product_dir: str):
+        '''
+        creates the local directory of a product, only once per session
+        '''
+        product_dir_local = Path(self.outputPath)/HRWSIRequest.RESULT_DIR/os.path.basename(product_dir)
+        with self.created_dirs_lock:
+            if product_dir_local in self.created_dirs:
+                return product_dir_local
+        product_dir_local.mkdir(parents=True, exist_ok=True)
+        with self.created_dirs_lock:
+            self.created_dirs.add(product_dir_local)
+        return product_dir_local
+
+    def is_downloaded(self, key: str, size: int, etag: str, obj_path: Path):
+        '''
+        checks if a layer was already downloaded: the local file must have the size of the S3 object
+        and, when the ETag of the object is its MD5 (not a multipart upload), the same MD5.
+        '''
+        try:
+            st = obj_path.stat()
+        except FileNotFoundError:
+            return False
+        if st.st_size != size:
+            return False
+
+        if '-' in etag:
+            return True
+        md5 = hashlib.md5()
+        with open(obj_path, 'rb') as f:
+            for chunk in iter(lambda: f.read(HRWSIRequest.MULTIPART_CHUNKSIZE), b''):
+                md5.update(chunk)
+        return md5.hexdigest() == etag
 
     @retry(EndpointConnectionError, tries=3, delay=2)
-    def download_from_s3(self, product_dir: str):
+    def download_from_s3(self, product: dict):
         '''
         function for downloading all the files (layers) of one product
-        call s3 a first time to list the layers.
-        call s3 for each layer to download
+        the layers are taken from the query file, s3 is only called to list them
+        for query files generated by previous versions.
+        layers already present on disk with the same size and MD5 are skipped.
+        submit each layer to the transfer manager and wait for all of them to be downloaded
         '''
 
         err = None
+        product_dir = product['product']
 
         try:
-            for obj in self.s3_client.Bucket(HRWSIRequest.BUCKET).objects.filter(Prefix = product_dir):
-                obj_path = Path(os.path.join(self.outputPath,HRWSIRequest.RESULT_DIR,os.path.basename(product_dir),os.path.basename(obj.key)))
-                obj_path.parent.mkdir(parents=True, exist_ok=True)
-                self.s3_client.Bucket(HRWSIRequest.BUCKET).download_file(obj.key, obj_path)
+            keys = product['keys']
+            sizes = product['sizes']
+            etags = product['etags']
+            if keys is None:
+                objs = [obj
+                        for page in self.list_paginator.paginate(Bucket=HRWSIRequest.BUCKET, Prefix=product_dir)
+                        for obj in page.get('Contents', [])]
+                keys = [obj['Key'] for obj in objs]
+                sizes = [obj['Size'] for obj in objs]
+                etags = [obj['ETag'].strip('"') for obj in objs]
+            product_dir_local = self.make_product_dir(product_dir)
+            futures = []
+            for key, size, etag in zip(keys, sizes, etags):
+                obj_path = product_dir_local/os.path.basename(key)
+                if self.is_downloaded(key, size, etag, obj_path):
+                    logging.debug(f"{key} already downloaded, skipped")
+                    continue
+                futures.append(self.transfer_manager.download(HRWSIRequest.BUCKET, key, str(obj_path),
+                                                              subscribers=[TransferSizeSubscriber(size, etag)]))
+            try:
+                for future in futures:
+                    future.result()
+            except BaseException:
+                # do not keep downloading the other layers of a failed product
+                for future in futures:
+                    future.cancel()
+                raise
 
         except ClientError as err:
             if err  == "404":
@@ -482,7 +661,7 @@ def main():
     # Parameter to download products found with last query
     group_download = parser.add_argument_group("download_params", "mandatory parameters for query_and_download or download modes")
     group_download.add_argument("-query_file", type=str, \
-        help="takes a .txt file containing a list of HR-WSI products to download. Path in the format productType/tile(minus the 'T')/year/month/day/product_name")
+        help="takes a .txt file generated with -query containing a list of HR-WSI products to download, one JSON object per line. A plain list of product paths in the format productType/tile(minus the 'T')/year/month/day/product_name is also accepted.")
 
     args = parser.parse_args()
 